@@ -1,131 +1,558 @@
 import imaplib
 import email
 from email.header import decode_header
-from transformers import pipeline
-import openpyxl
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+import torch
+import numpy as np
+import xlsxwriter
 import os
+import shutil
 from tqdm import tqdm
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import smtplib
 from email.message import EmailMessage
 import re
+try:
+    # RE2 matches in linear time with no backtracking; fall back to the stdlib engine
+    import re2 as text_re
+except ImportError:
+    text_re = re
+import queue
+import threading
+import hashlib
+import shelve
+import dbm
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No advisory file locks on Windows
+import time
+from collections import Counter
+import binascii
+import quopri
+
+MODEL_NAME = "SamLowe/roberta-base-go_emotions"  # Better for detecting emotions in text
+FETCH_CHUNK_SIZE = 50  # Messages requested per IMAP FETCH command
+BATCH_WAIT_SECONDS = 0.5  # How long the analyzer waits to fill a batch before running it
+KEEPALIVE_SECONDS = 240  # Idle time after which a cached mail session is checked with NOOP
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "email_tone")
+QUANTIZED_MODEL_DIR = os.path.join(CACHE_DIR, "roberta-go-emotions-int8")
+
+# Loaded (tokenizer, model) pairs, keyed by model, device, dtype and compile flag
+_MODEL_CACHE = {}
+
+# Text patterns, compiled once (inline flags work in both RE2 and re).
+# RE2's \s is ASCII-only, so whitespace is spelled out as the exact set of
+# characters Python's \s matches (including the NBSP selectolax emits for
+# &nbsp;) to keep cleaned text identical whichever engine is installed
+_WS_CHARS = '\t\n\x0b\x0c\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000'
+_TAG_RE = text_re.compile(r'<[^>]+>')
+_SIG_RE = text_re.compile('(?s)--+[' + _WS_CHARS + ']*\n.*')
+_URL_RE = text_re.compile('http[^' + _WS_CHARS + ']+')
+_WS_RE = text_re.compile('[' + _WS_CHARS + ']+')
+_NONASCII_RE = text_re.compile(r'[^\x20-\x7e\n]')
+_BOILERPLATE_RE = text_re.compile(r'(?i)unsubscribe|no[- ]reply|verification code|your otp')
+
+# IMAP response patterns
+_FETCH_START_RE = re.compile(rb'^(\d+) \(')
+_LITERAL_RE = re.compile(rb'\{\d+\}$')
+_DATA_ITEM_RE = re.compile(rb'(?:\]|RFC822)\s*$')
+_IMAP_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+_IMAP_ESCAPE_RE = re.compile(rb'\\(.)')
+
+def _parse_imap_list(data):
+    """Parse an IMAP parenthesized list (e.g. a BODYSTRUCTURE) into nested Python lists"""
+    stack = [[]]
+    for token in _IMAP_TOKEN_RE.findall(data):
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) == 1:
+                raise ValueError("Unbalanced parentheses in IMAP response")
+            item = stack.pop()
+            stack[-1].append(item)
+        elif token.startswith(b'"'):
+            stack[-1].append(_IMAP_ESCAPE_RE.sub(rb'\1', token[1:-1]).decode(errors="ignore"))
+        elif token.upper() == b'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token.decode(errors="ignore"))
+    if len(stack) != 1:
+        raise ValueError("Unbalanced parentheses in IMAP response")
+    return stack[0]
+
+def _text_parts(structure, section=""):
+    """Yield (section, subtype, encoding, charset) for every text part of a BODYSTRUCTURE"""
+    if structure and isinstance(structure[0], list):
+        # Multipart: the child parts come first, followed by the subtype
+        for n, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            yield from _text_parts(child, f"{section}.{n}" if section else str(n))
+    elif len(structure) >= 6 and str(structure[0]).lower() == "text":
+        params = structure[2] if isinstance(structure[2], list) else []
+        params = {str(k).lower(): v for k, v in zip(params[::2], params[1::2])}
+        yield section or "1", str(structure[1]).lower(), structure[5], params.get("charset")
+
+def sanitize_for_excel(text):
+    """Sanitize text for Excel to prevent formula and special character issues"""
+    if not text:
+        return ""
+    # Most fields are already printable ASCII; otherwise keep tabs as spaces,
+    # then drop control and non-ASCII characters in one pass
+    if not (text.isascii() and text.isprintable()):
+        text = _NONASCII_RE.sub('', text.replace('\t', ' '))
+    # Truncate excessively long strings
+    max_length = 32767
+    if len(text) > max_length:
+        text = text[:max_length - 3] + "..."
+    # Add single quotes to prevent formula interpretation
+    if text and text[0] in ['=', '+', '-', '@']:
+        text = "'" + text
+    return text
 
 class EmailToneAnalyzer:
-    def __init__(self, imap_server, email_account, email_password, mailbox="INBOX"):
+    def __init__(self, imap_server, email_account, email_password, mailbox="INBOX", quantize=False,
+                 compile_model=False):
         # Email configuration
         self.imap_server = imap_server
         self.email_account = email_account
         self.email_password = email_password
         self.mailbox = mailbox
         
+        # Mail sessions are opened lazily and reused across calls
+        self._imap_conn = None
+        self._imap_used = 0.0
+        self._smtp_conn = None
+        self._smtp_used = 0.0
+        
         # Set up transformer model for sentiment analysis
-        print("Loading sentiment analysis model...")
-        self.sentiment_pipeline = pipeline(
-            "text-classification", 
-            model="SamLowe/roberta-base-go_emotions",  # Better for detecting emotions in text
-            top_k=None  # Return all emotions with scores
-        )
+        if quantize:
+            self.device = torch.device("cpu")
+            key = (QUANTIZED_MODEL_DIR, self.device.type, "int8", False)
+        else:
+            # Run on the GPU in half precision when one is available
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+            key = (MODEL_NAME, self.device.type, dtype, compile_model)
+        
+        # Models are loaded once per process and shared by every analyzer
+        if key not in _MODEL_CACHE:
+            print("Loading sentiment analysis model...")
+            if quantize:
+                _MODEL_CACHE[key] = self._load_quantized_model()
+            else:
+                _MODEL_CACHE[key] = self._load_model(dtype, compile_model)
+        self.tokenizer, self.model = _MODEL_CACHE[key]
         
-        # Create Excel file
+        # Emotion labels in the order of the model's output scores
+        id2label = self.model.config.id2label
+        self._labels = np.array([id2label[i] for i in range(len(id2label))])
+        
+        # Cache of previously analyzed email bodies, one file per model variant
+        # since their scores differ; opened by fetch_and_analyze_emails
+        model_tag = "int8" if quantize else f"{self.device.type}-{str(dtype).replace('torch.', '')}"
+        self._cache_file = os.path.join(CACHE_DIR, f"emotions-{model_tag}")
+        self._cache = None
+        self._cache_lock = None
+        
+        self._new_report()
+    
+    def _new_report(self):
+        """Start a fresh Excel report for the next analysis run"""
         self.today_str = datetime.now().strftime("%Y-%m-%d")
         self.excel_file = f"email_tone_{self.today_str}.xlsx"
-        self.wb = openpyxl.Workbook()
-        self.ws = self.wb.active
-        self.ws.append(["Sender", "Subject", "Date", "Primary Emotion", "Score", "Secondary Emotions"])
+        # Constant-memory mode flushes each row to disk as soon as the next one starts;
+        # subjects are plain text, so skip the per-cell URL detection too
+        self.wb = xlsxwriter.Workbook(self.excel_file, {'constant_memory': True, 'strings_to_urls': False})
+        self.ws = self.wb.add_worksheet("Tone")
+        self._saved = False
         
         # Apply formatting 
-        for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G']:
-            self.ws.column_dimensions[col].width = 25
+        self.ws.set_column('A:G', 25)
+        
+        self.ws.write_row(0, 0, ["Sender", "Subject", "Date", "Primary Emotion", "Score", "Secondary Emotions"])
+        self._row = 1
+        
+        # Primary emotion of every written row, for the summary (cells can't be read back)
+        self._emotion_log = []
+    
+    def _load_model(self, dtype, compile_model):
+        """Load the tokenizer and PyTorch model onto the analyzer's device"""
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        model = AutoModelForSequenceClassification.from_pretrained(
+            MODEL_NAME, torch_dtype=dtype
+        ).to(self.device).eval()
+        
+        if compile_model:
+            # Fuse kernels with torch.compile; batch shapes vary, so compile dynamically
+            print("Compiling sentiment analysis model...")
+            model = torch.compile(model, mode="reduce-overhead", dynamic=True)
+            # Warm up on a padded batch of two lengths so the first compile isn't
+            # specialized to a single sequence
+            warmup = ["Warming up.", "Warming up the model with a longer sentence."]
+            with torch.inference_mode():
+                model(**tokenizer(warmup, padding=True, return_tensors="pt").to(self.device))
+        
+        return tokenizer, model
+    
+    def _load_quantized_model(self):
+        """Load an int8-quantized ONNX export of the model, quantizing it on first run"""
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        
+        complete = all(
+            os.path.isfile(os.path.join(QUANTIZED_MODEL_DIR, name))
+            for name in ("model_quantized.onnx", "tokenizer_config.json")
+        )
+        if not complete:
+            print("Quantizing sentiment analysis model (first run only)...")
+            # Build in a scratch directory and rename it into place once complete,
+            # so an interrupted run never leaves a half-written model behind
+            tmp_dir = QUANTIZED_MODEL_DIR + ".tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            ort_model = ORTModelForSequenceClassification.from_pretrained(
+                MODEL_NAME, export=True, provider="CPUExecutionProvider"
+            )
+            quantizer = ORTQuantizer.from_pretrained(ort_model)
+            quantizer.quantize(
+                save_dir=tmp_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False),
+            )
+            AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(tmp_dir)
+            shutil.rmtree(QUANTIZED_MODEL_DIR, ignore_errors=True)
+            os.rename(tmp_dir, QUANTIZED_MODEL_DIR)
+        
+        ort_model = ORTModelForSequenceClassification.from_pretrained(
+            QUANTIZED_MODEL_DIR, file_name="model_quantized.onnx", provider="CPUExecutionProvider"
+        )
+        tokenizer = AutoTokenizer.from_pretrained(QUANTIZED_MODEL_DIR)
+        return tokenizer, ort_model
     
     def clean_text(self, text):
         """Clean text for better sentiment analysis"""
         if not text:
             return ""
         
-        # Remove HTML tags
-        text = re.sub(r'<[^>]+>', ' ', text)
+        # Remove HTML tags (bodies from html_to_text are already tag-free)
+        if '<' in text:
+            text = _TAG_RE.sub(' ', text)
         
         # Remove email signatures
-        text = re.sub(r'--+\s*\n.*', '', text, flags=re.DOTALL)
+        text = _SIG_RE.sub('', text)
         
         # Remove URLs
-        text = re.sub(r'http\S+', '', text)
+        text = _URL_RE.sub('', text)
         
         # Remove extra whitespace
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = _WS_RE.sub(' ', text).strip()
         
         return text
     
-    def analyze_tone(self, text):
-        """Analyze the emotional tone of text using transformer model"""
-        if not text or len(text.strip()) < 5:
+    def _summarize_scores(self, scores):
+        """Turn a (texts, labels) score matrix into primary/secondary emotions per text"""
+        primary_idx = scores.argmax(axis=1)
+        primary_scores = scores.max(axis=1)
+        
+        # Secondary emotions are the other labels scoring above 0.1
+        secondary_mask = scores > 0.1
+        secondary_mask[np.arange(len(scores)), primary_idx] = False
+        
+        tones = []
+        for i, row_mask in enumerate(secondary_mask):
+            # Strongest first, as the report has always listed them
+            idx = np.flatnonzero(row_mask)
+            idx = idx[np.argsort(-scores[i, idx], kind="stable")]
+            secondary_emotions = {str(self._labels[j]): round(float(scores[i, j]), 3) for j in idx}
+            tones.append((str(self._labels[primary_idx[i]]).upper(), round(float(primary_scores[i]), 3), secondary_emotions))
+        
+        return tones
+    
+    def _prefilter_tone(self, cleaned_text):
+        """Return a canned tone for trivial emails, or None if the model is needed"""
+        n_words = len(cleaned_text.split())
+        if n_words < 5:
             return "NEUTRAL", 0.5, {}
         
-        cleaned_text = self.clean_text(text)
+        # Short auto-replies, OTP codes and unsubscribe footers carry no real tone
+        if n_words < 40 and _BOILERPLATE_RE.search(cleaned_text):
+            return "NEUTRAL", 1.0, {}
         
-        # For very long texts, analyze only the first 1024 tokens
-        # Most important emotional content tends to be at the beginning
-        max_length = 1024
+        return None
+    
+    def analyze_tones(self, texts, batch_size=32):
+        """Analyze the emotional tone of many texts in batched forward passes"""
+        tones = [("NEUTRAL", 0.5, {})] * len(texts)
         
-        try:
-            results = self.sentiment_pipeline(cleaned_text[:max_length])
-            if not results or not results[0]:
-                return "NEUTRAL", 0.5, {}
-            
-            # Get all emotions with scores
-            emotions = {item['label']: item['score'] for item in results[0]}
+        # Only texts that the cheap rules can't classify are sent to the model
+        pending = []
+        for i, text in enumerate(texts):
+            if not text or len(text.strip()) < 5:
+                continue
+            cleaned_text = self.clean_text(text)
+            canned_tone = self._prefilter_tone(cleaned_text)
+            if canned_tone:
+                tones[i] = canned_tone
+                continue
             
-            # Find primary emotion (highest score)
-            primary_emotion = max(emotions.items(), key=lambda x: x[1])
+            # Reuse the result for bodies analyzed before (newsletters, notifications)
+            content_hash = hashlib.blake2b(cleaned_text.encode(), digest_size=16).hexdigest()
+            if self._cache is not None and content_hash in self._cache:
+                tones[i] = self._cache[content_hash]
+                continue
+            pending.append((i, cleaned_text, content_hash))
+        
+        if not pending:
+            return tones
+        
+        try:
+            # Tokenize everything once, letting the tokenizer bound each text to the
+            # model's 512-token window; most important emotional content tends to be
+            # at the beginning
+            encodings = self.tokenizer(
+                [cleaned_text for _, cleaned_text, _ in pending],
+                truncation=True,
+                max_length=512,
+            )
             
-            # Get secondary emotions (emotions with scores > 0.1)
-            secondary_emotions = {k: round(v, 3) for k, v in emotions.items() 
-                                 if v > 0.1 and k != primary_emotion[0]}
+            # Sort by token length so each batch holds similar-length texts and
+            # little compute is wasted on padding; scores are written back by index
+            order = sorted(range(len(pending)), key=lambda j: len(encodings["input_ids"][j]))
             
-            return primary_emotion[0].upper(), round(primary_emotion[1], 3), secondary_emotions
+            # Call the model directly, skipping the pipeline's per-example
+            # pre/post-processing; go_emotions is multi-label, hence the sigmoid
+            scores = np.zeros((len(pending), len(self._labels)), dtype=np.float32)
+            with torch.inference_mode():
+                for start in range(0, len(order), batch_size):
+                    batch = order[start:start + batch_size]
+                    enc = self.tokenizer.pad(
+                        {key: [encodings[key][j] for j in batch] for key in encodings.keys()},
+                        return_tensors="pt",
+                    ).to(self.device)
+                    scores[batch] = self.model(**enc).logits.float().sigmoid().cpu().numpy()
             
+            for (i, _, content_hash), tone in zip(pending, self._summarize_scores(scores)):
+                tones[i] = tone
+                if self._cache is not None:
+                    self._cache[content_hash] = tone
         except Exception as e:
             print(f"Error analyzing tone: {e}")
-            return "ERROR", 0.0, {}
+            for i, _, _ in pending:
+                tones[i] = ("ERROR", 0.0, {})
+        
+        return tones
+    
+    def analyze_tone(self, text):
+        """Analyze the emotional tone of text using transformer model"""
+        return self.analyze_tones([text])[0]
+    
+    def html_to_text(self, html):
+        """Strip HTML markup using selectolax's C-backed Lexbor parser"""
+        tree = LexborHTMLParser(html)
+        return tree.body.text(separator=' ') if tree.body else ""
     
     def extract_email_body(self, msg):
         """Extract email body text, handling multipart messages"""
-        body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                try:
-                    if content_type == "text/plain":
-                        body = part.get_payload(decode=True).decode(errors="ignore")
-                        break
-                    elif content_type == "text/html" and not body:
-                        html = part.get_payload(decode=True).decode(errors="ignore")
-                        soup = BeautifulSoup(html, "html.parser")
-                        body = soup.get_text()
-                except Exception as e:
-                    print(f"Error parsing email part: {e}")
-        else:
-            content_type = msg.get_content_type()
+        # Pick the first text/plain part, else the first text/html part, and
+        # decode only that one
+        plain, html = None, None
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if content_type == "text/plain" and plain is None:
+                plain = part
+                break
+            elif content_type == "text/html" and html is None:
+                html = part
+        
+        chosen = plain if plain is not None else html
+        if chosen is None:
+            return ""
+        
+        try:
+            raw = chosen.get_payload(decode=True) or b""
             try:
-                if content_type == "text/plain":
-                    body = msg.get_payload(decode=True).decode(errors="ignore")
-                elif content_type == "text/html":
-                    html = msg.get_payload(decode=True).decode(errors="ignore")
-                    soup = BeautifulSoup(html, "html.parser")
-                    body = soup.get_text()
-            except Exception as e:
-                print(f"Error decoding email body: {e}")
+                text = raw.decode(chosen.get_content_charset() or "utf-8", errors="ignore")
+            except LookupError:
+                text = raw.decode("utf-8", errors="ignore")
+            return text if chosen is plain else self.html_to_text(text)
+        except Exception as e:
+            print(f"Error decoding email body: {e}")
+            return ""
+    
+    def _parse_headers(self, msg):
+        """Extract (sender, subject, date) from a parsed message"""
+        subject, encoding = decode_header(msg["Subject"] or "")[0]
+        if isinstance(subject, bytes):
+            subject = subject.decode(encoding if encoding else "utf-8")
+        
+        return msg.get("From"), subject, msg.get("Date")
+    
+    def _parse_message(self, raw_email):
+        """Parse a raw RFC822 message into (sender, subject, date, body)"""
+        msg = email.message_from_bytes(raw_email)
         
-        return body
+        # Extract email metadata
+        from_, subject, date_ = self._parse_headers(msg)
+        
+        # Extract body
+        body = self.extract_email_body(msg)
+        
+        return from_, subject, date_, body
+    
+    def _decode_part(self, data, subtype, encoding, charset):
+        """Decode a single fetched MIME part into plain text"""
+        encoding = (encoding or "").lower()
+        try:
+            if encoding == "base64":
+                data = binascii.a2b_base64(data)
+            elif encoding == "quoted-printable":
+                data = quopri.decodestring(data)
+        except (binascii.Error, ValueError) as e:
+            print(f"Error decoding email part: {e}")
+            return ""
+        
+        try:
+            text = data.decode(charset or "utf-8", errors="ignore")
+        except LookupError:
+            text = data.decode("utf-8", errors="ignore")
+        
+        return self.html_to_text(text) if subtype == "html" else text
     
-    def fetch_and_analyze_emails(self, days_back=1):
+    def _split_fetch_response(self, msg_data):
+        """Split a multi-message FETCH response into (message number, response text, header literal)
+        
+        Literals other than the requested header fields (e.g. long filenames inside a
+        BODYSTRUCTURE) are inlined as quoted strings so the text parses as one list.
+        """
+        messages = []
+        for part in msg_data:
+            prefix, literal = part if isinstance(part, tuple) else (part, None)
+            if prefix is None:
+                continue
+            
+            match = _FETCH_START_RE.match(prefix)
+            if match:
+                messages.append([match.group(1), b"", None])
+            elif not messages:
+                continue
+            
+            if literal is None:
+                messages[-1][1] += prefix
+                continue
+            
+            prefix = _LITERAL_RE.sub(b"", prefix.rstrip())
+            if _DATA_ITEM_RE.search(prefix):
+                # BODY[...] or RFC822 message data
+                messages[-1][1] += prefix + b"NIL"
+                messages[-1][2] = literal
+            else:
+                quoted = literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+                messages[-1][1] += prefix + b'"' + quoted + b'"'
+        
+        return messages
+    
+    def _fetch_chunk(self, mail, chunk):
+        """Fetch headers and just the relevant text part of each message in a chunk"""
+        _, msg_data = mail.fetch(b",".join(chunk), "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])")
+        
+        # Locate the first text/plain part (falling back to text/html) of every message
+        wanted = set(chunk)
+        parsed = {}
+        sections = {}
+        fallback = []
+        for num, response, header in self._split_fetch_response(msg_data):
+            # Skip unsolicited FETCH responses (e.g. FLAGS updates) and
+            # messages outside this chunk or already handled
+            if num not in wanted or num in parsed or num in fallback or b"BODYSTRUCTURE" not in response:
+                continue
+            try:
+                items = _parse_imap_list(response)[1]
+                structure = items[items.index("BODYSTRUCTURE") + 1]
+                text_parts = list(_text_parts(structure))
+            except (ValueError, IndexError, TypeError) as e:
+                print(f"Error parsing message structure: {e}")
+                fallback.append(num)
+                continue
+            
+            parsed[num] = self._parse_headers(email.message_from_bytes(header or b""))
+            text_part = next((p for p in text_parts if p[1] == "plain"), None) or \
+                next((p for p in text_parts if p[1] == "html"), None)
+            if text_part:
+                sections.setdefault(text_part[0], []).append((num, text_part))
+            else:
+                parsed[num] += ("",)
+        
+        # Download only the chosen part, one FETCH per distinct section number
+        for section, entries in sections.items():
+            _, msg_data = mail.fetch(b",".join(num for num, _ in entries), f"(BODY.PEEK[{section}])")
+            bodies = {}
+            for num, _, data in self._split_fetch_response(msg_data):
+                if data is not None:
+                    bodies.setdefault(num, data)
+            for num, (_, subtype, encoding, charset) in entries:
+                parsed[num] += (self._decode_part(bodies.get(num, b""), subtype, encoding, charset),)
+        
+        # Messages whose structure couldn't be parsed are downloaded whole,
+        # still without setting \Seen
+        if fallback:
+            _, msg_data = mail.fetch(b",".join(fallback), "(BODY.PEEK[])")
+            for num, _, raw_email in self._split_fetch_response(msg_data):
+                if raw_email is not None and num in fallback and num not in parsed:
+                    parsed[num] = self._parse_message(raw_email)
+        
+        return [parsed[num] for num in chunk if num in parsed]
+    
+    def _fetch_worker(self, mail, email_ids, fetch_queue, stop):
+        """Fetch and parse emails in bulk message sets, feeding them to the analysis queue"""
+        try:
+            for i in range(0, len(email_ids), FETCH_CHUNK_SIZE):
+                if stop.is_set():
+                    break
+                chunk = email_ids[i:i + FETCH_CHUNK_SIZE]
+                for fetched in self._fetch_chunk(mail, chunk):
+                    fetch_queue.put(fetched)
+        except Exception as e:
+            print(f"Error fetching emails: {e}")
+            # The session may be mid-response; don't hand it to the next run
+            self._close_imap()
+        finally:
+            # Signal the consumer that no more emails are coming
+            fetch_queue.put(None)
+    
+    def _write_row(self, from_, subject, date_, tone):
+        """Append one analyzed email to the Excel sheet"""
+        primary_emotion, score, secondary_emotions = tone
+        
+        # Format secondary emotions for Excel
+        secondary_emotions_text = ", ".join([f"{k}: {v}" for k, v in secondary_emotions.items()])
+        
+        # Sanitize all text fields
+        safe_from = sanitize_for_excel(from_)
+        safe_subject = sanitize_for_excel(subject)
+        safe_date = sanitize_for_excel(date_)
+        safe_emotion = sanitize_for_excel(primary_emotion)
+        safe_secondary = sanitize_for_excel(secondary_emotions_text)
+        
+        # Append to Excel with sanitized values
+        self.ws.write_row(self._row, 0, [
+            safe_from, 
+            safe_subject, 
+            safe_date, 
+            safe_emotion, 
+            score,  # Numeric value doesn't need sanitizing
+            safe_secondary,
+        ])
+        self._row += 1
+        self._emotion_log.append(safe_emotion)
+    
+    def fetch_and_analyze_emails(self, days_back=1, batch_size=32):
         """Fetch emails from the last X days and analyze their tone"""
+        # The result cache is only held open while emails are being analyzed
+        self._open_cache()
         try:
-            # Connect to IMAP
-            mail = imaplib.IMAP4_SSL(self.imap_server)
-            mail.login(self.email_account, self.email_password)
-            mail.select(self.mailbox)
+            # Connect to IMAP (reusing the open session if there is one)
+            mail = self._imap()
             
             # Search emails from the specified time period
             date_since = (datetime.now() - timedelta(days=days_back)).strftime("%d-%b-%Y")
@@ -138,81 +565,95 @@ class EmailToneAnalyzer:
                 
             print(f"Found {len(email_ids)} emails to analyze")
             
-            # Process emails
-            for eid in tqdm(email_ids, desc="Processing Emails", unit="email"):
-                _, msg_data = mail.fetch(eid, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        # Extract email metadata
-                        subject, encoding = decode_header(msg["Subject"])[0]
-                        if isinstance(subject, bytes):
-                            subject = subject.decode(encoding if encoding else "utf-8")
-                        
-                        from_ = msg.get("From")
-                        date_ = msg.get("Date")
-                        
-                        # Extract body
-                        body = self.extract_email_body(msg)
-                        
-                        # Analyze tone
-                        primary_emotion, score, secondary_emotions = self.analyze_tone(body)
-                        
-                        # Format secondary emotions for Excel
-                        secondary_emotions_text = ", ".join([f"{k}: {v}" for k, v in secondary_emotions.items()])
-                        
-                        # Truncate body for Excel preview
-                        preview = body[:300] + "..." if len(body) > 300 else body
-                        preview = preview.replace("\n", " ").strip()
-                        
-                        # Sanitize text for Excel to prevent formula and special character issues
-                        def sanitize_for_excel(text):
-                            if not text:
-                                return ""
-                            # Remove null bytes and replace problematic characters
-                            text = text.replace('\x00', '').replace('\r', '').replace('\t', ' ')
-                            # Remove non-ASCII characters
-                            text = text.encode("ascii", "ignore").decode()
-                            # Truncate excessively long strings
-                            max_length = 32767
-                            if len(text) > max_length:
-                                text = text[:max_length - 3] + "..."
-                            # Add single quotes to prevent formula interpretation
-                            if isinstance(text, str) and text and text[0] in ['=', '+', '-', '@']:
-                                text = "'" + text
-                            return text
-                        
-                        # Sanitize all text fields
-                        safe_from = sanitize_for_excel(from_)
-                        safe_subject = sanitize_for_excel(subject)
-                        safe_date = sanitize_for_excel(date_)
-                        safe_emotion = sanitize_for_excel(primary_emotion)
-                        safe_secondary = sanitize_for_excel(secondary_emotions_text)
-                        
-                        # Append to Excel with sanitized values
-                        self.ws.append([
-                            safe_from, 
-                            safe_subject, 
-                            safe_date, 
-                            safe_emotion, 
-                            score,  # Numeric value doesn't need sanitizing
-                            safe_secondary,
-                        ])
+            # Three overlapping stages: a background thread fetches, this thread
+            # analyzes what has already arrived, and another thread writes the
+            # rows; the bounded queues apply backpressure
+            max_pending = 4 * batch_size
+            fetch_queue = queue.Queue(maxsize=max_pending)
+            write_queue = queue.Queue(maxsize=max_pending)
+            stop = threading.Event()
+            producer_thread = threading.Thread(
+                target=self._fetch_worker, args=(mail, email_ids, fetch_queue, stop), daemon=True
+            )
+            writer_thread = threading.Thread(target=self._write_worker, args=(write_queue,), daemon=True)
+            producer_thread.start()
+            writer_thread.start()
             
-            # Close the connection
-            mail.logout()
+            try:
+                self._analyze_stage(fetch_queue, write_queue, len(email_ids), batch_size)
+            finally:
+                # Let the writer finish every queued row before the report is saved
+                write_queue.put(None)
+                writer_thread.join()
+                # If analysis failed, the fetcher may be blocked on the full queue;
+                # stop it and drain the queue so it can finish with the session
+                stop.set()
+                while producer_thread.is_alive():
+                    try:
+                        fetch_queue.get(timeout=BATCH_WAIT_SECONDS)
+                    except queue.Empty:
+                        pass
+                producer_thread.join()
             
         except Exception as e:
             print(f"Error fetching emails: {e}")
+            # Don't reuse a session that may be in a broken state
+            self._close_imap()
+        finally:
+            self._close_cache()
+    
+    def _write_worker(self, write_queue):
+        """Write analyzed emails to the Excel sheet as they come off the queue"""
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            try:
+                self._write_row(*item)
+            except Exception as e:
+                print(f"Error writing row: {e}")
+    
+    def _analyze_stage(self, fetch_queue, write_queue, total, batch_size):
+        """Analyze fetched emails in batches and hand the results to the writer"""
+        max_pending = fetch_queue.maxsize
+        progress = tqdm(total=total, desc="Processing Emails", unit="email")
+        done = False
+        while not done:
+            # Wait for the first email, then drain whatever else is ready
+            item = fetch_queue.get()
+            fetched = []
+            while item is not None:
+                fetched.append(item)
+                if len(fetched) >= max_pending:
+                    break
+                try:
+                    item = fetch_queue.get(timeout=BATCH_WAIT_SECONDS)
+                except queue.Empty:
+                    break
+            done = item is None
+            
+            if not fetched:
+                continue
+            
+            # Analyze tone of the drained bodies in batches
+            tones = self.analyze_tones([body for _, _, _, body in fetched], batch_size=batch_size)
+            for (from_, subject, date_, body), tone in zip(fetched, tones):
+                write_queue.put((from_, subject, date_, tone))
+            progress.update(len(fetched))
+        progress.close()
+    
+    def save_report(self):
+        """Write the Excel report to disk; the workbook can only be closed once"""
+        if not self._saved:
+            self.wb.close()
+            self._saved = True
     
     def send_report_via_email(self, to_email):
         """Send the Excel report via email"""
         # Save Excel file first
-        self.wb.save(self.excel_file)
+        self.save_report()
         
         from_email = self.email_account
-        from_password = self.email_password
         
         msg = EmailMessage()
         msg["Subject"] = f"Daily Email Sentiment Analysis Report - {self.today_str}"
@@ -220,18 +661,15 @@ class EmailToneAnalyzer:
         msg["To"] = to_email
         
         # Add summary content
-        total_emails = self.ws.max_row - 1  # Subtract header row
+        total_emails = len(self._emotion_log)
         
         # Count each primary emotion type
-        emotion_counts = {}
-        for row in range(2, self.ws.max_row + 1):
-            emotion = self.ws.cell(row=row, column=4).value
-            emotion_counts[emotion] = emotion_counts.get(emotion, 0) + 1
+        emotion_counts = Counter(self._emotion_log)
         
         # Format emotion summary
         emotion_summary = "\n".join([
             f"- {emotion}: {count} emails ({round(count/total_emails*100, 1)}%)" 
-            for emotion, count in sorted(emotion_counts.items(), key=lambda x: x[1], reverse=True)
+            for emotion, count in emotion_counts.most_common()
         ])
         
         content = f"""Dear Sir Bilal,
@@ -268,19 +706,102 @@ We read between the lines — and also judge them.
             )
         
         try:
-            server = smtplib.SMTP_SSL(self.imap_server, 465)
-            server.login(from_email, from_password)
-            server.send_message(msg)
-            server.quit()
+            self._send_message(msg)
             print(f"📧 Report emailed successfully to {to_email}")
         except Exception as e:
             print(f"❌ Failed to send email: {e}")
+            self._close_smtp()
+    
+    def _send_message(self, msg):
+        """Send a message on the cached SMTP session, reconnecting once if the server dropped it"""
+        try:
+            self._smtp().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # smtplib has already closed the dead socket
+            self._smtp_conn = None
+            self._smtp().send_message(msg)
+    
+    def _connection_alive(self, conn, last_used, ok_status):
+        """Check an idle connection with a NOOP; recently used ones are assumed alive"""
+        if time.monotonic() - last_used < KEEPALIVE_SECONDS:
+            return True
+        try:
+            return conn.noop()[0] == ok_status
+        except Exception:
+            return False
+    
+    def _imap(self):
+        """Return a logged-in IMAP session with the mailbox selected, reconnecting if needed"""
+        if self._imap_conn is None or not self._connection_alive(self._imap_conn, self._imap_used, "OK"):
+            self._close_imap()
+            self._imap_conn = imaplib.IMAP4_SSL(self.imap_server)
+            self._imap_conn.login(self.email_account, self.email_password)
+            self._imap_conn.select(self.mailbox)
+        self._imap_used = time.monotonic()
+        return self._imap_conn
+    
+    def _smtp(self):
+        """Return a logged-in SMTP session, reconnecting if needed"""
+        if self._smtp_conn is None or not self._connection_alive(self._smtp_conn, self._smtp_used, 250):
+            self._close_smtp()
+            self._smtp_conn = smtplib.SMTP_SSL(self.imap_server, 465)
+            self._smtp_conn.login(self.email_account, self.email_password)
+        self._smtp_used = time.monotonic()
+        return self._smtp_conn
+    
+    def _close_imap(self):
+        """Log out of the cached IMAP session, if any"""
+        if self._imap_conn is not None:
+            try:
+                self._imap_conn.logout()
+            except Exception as e:
+                print(f"Error closing IMAP connection: {e}")
+            self._imap_conn = None
+    
+    def _close_smtp(self):
+        """Quit the cached SMTP session, if any"""
+        if self._smtp_conn is not None:
+            try:
+                self._smtp_conn.quit()
+            except Exception as e:
+                print(f"Error closing SMTP connection: {e}")
+            self._smtp_conn = None
+    
+    def _open_cache(self):
+        """Open the result cache, running without it if another analyzer holds it"""
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Not every dbm backend locks its files, so take an exclusive lock first
+            self._cache_lock = open(self._cache_file + ".lock", "w")
+            if fcntl:
+                fcntl.flock(self._cache_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._cache = shelve.open(self._cache_file)
+        except dbm.error as e:  # dbm.error already includes OSError
+            print(f"Result cache unavailable, analyzing without it: {e}")
+            self._close_cache()
+    
+    def _close_cache(self):
+        """Flush and close the result cache and release its lock"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        if self._cache_lock is not None:
+            self._cache_lock.close()
+            self._cache_lock = None
+    
+    def close(self):
+        """Close the mail connections"""
+        self._close_imap()
+        self._close_smtp()
     
     def run_analysis(self, days_back=1, recipient_email=None):
-        """Run the complete analysis workflow"""
+        """Run the complete analysis workflow (call close() when done with the analyzer)"""
+        if self._saved:
+            self._new_report()
+        
         print(f"🔍 Starting email tone analysis for the past {days_back} days...")
         self.fetch_and_analyze_emails(days_back)
-        self.wb.save(self.excel_file)
+        self.save_report()
         print(f"💾 Analysis saved to {self.excel_file}")
         
         if recipient_email:
@@ -305,5 +826,8 @@ if __name__ == "__main__":
         mailbox=MAILBOX
     )
     
-    analyzer.run_analysis(days_back=1, recipient_email="recipient@example.com")
+    try:
+        analyzer.run_analysis(days_back=1, recipient_email="recipient@example.com")
+    finally:
+        analyzer.close()
     
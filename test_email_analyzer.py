@@ -0,0 +1,350 @@
+import base64
+import hashlib
+import smtplib
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import numpy as np
+import pytest
+import torch
+
+from email_analyzer import (
+    EmailToneAnalyzer,
+    _parse_imap_list,
+    _text_parts,
+    sanitize_for_excel,
+)
+
+HEADER = b"From: Bob <bob@example.com>\r\nSubject: =?utf-8?q?Quarterly_update?=\r\nDate: Mon, 14 Oct 2024 10:00:00 +0000\r\n\r\n"
+HEADER_ITEM = b"BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {%d}" % len(HEADER)
+
+# multipart/alternative with a base64 text/plain part and an HTML part
+ALTERNATIVE = (
+    b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 16 1 NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 30 1 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b1") NIL NIL)'
+)
+# multipart/mixed wrapping an HTML-only alternative and a PDF attachment
+MIXED = (
+    b'((("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 16 1 NIL NIL NIL) "ALTERNATIVE")'
+    b'("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 99999 NIL NIL NIL) "MIXED")'
+)
+SINGLE = b'("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL "7BIT" 5 1 NIL NIL NIL)'
+
+
+class FakeIMAP:
+    """Replays recorded FETCH responses, keyed by the requested data items"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def fetch(self, message_set, items):
+        self.calls.append((message_set, items))
+        return "OK", self.responses[items]
+
+
+class BatchEncoding(dict):
+    """Padded tensors, movable to a device like transformers' BatchEncoding"""
+
+    def to(self, device):
+        return self
+
+
+class FakeTokenizer:
+    """Tokenizes one id per word and pads like a Hugging Face tokenizer"""
+
+    def __call__(self, texts, truncation=True, max_length=512):
+        input_ids = [list(range(len(text.split())))[:max_length] for text in texts]
+        return {"input_ids": input_ids, "attention_mask": [[1] * len(ids) for ids in input_ids]}
+
+    def pad(self, encodings, return_tensors="pt"):
+        width = max(len(ids) for ids in encodings["input_ids"])
+        return BatchEncoding({
+            key: torch.tensor([row + [0] * (width - len(row)) for row in rows])
+            for key, rows in encodings.items()
+        })
+
+
+class FakeModel:
+    """Scores "long" above 8 words and "short" below, more confidently the further from 8"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, input_ids, attention_mask):
+        self.batches.append(len(input_ids))
+        n_words = attention_mask.sum(dim=1).float()
+        return type("Output", (), {"logits": torch.stack([n_words - 8, 8 - n_words], dim=1)})
+
+
+@pytest.fixture
+def analyzer():
+    # Skip __init__: the helpers under test need neither the model nor a workbook
+    return EmailToneAnalyzer.__new__(EmailToneAnalyzer)
+
+
+def test_parse_imap_list():
+    parsed = _parse_imap_list(b'1 (FLAGS (\\Seen) X "a \\"quoted\\" name" NIL)')
+    assert parsed == ["1", ["FLAGS", ["\\Seen"], "X", 'a "quoted" name', None]]
+
+
+def test_parse_imap_list_unbalanced():
+    with pytest.raises(ValueError):
+        _parse_imap_list(b'1 (BODYSTRUCTURE ("TEXT" "PLAIN"')
+
+
+def test_text_parts():
+    assert list(_text_parts(_parse_imap_list(ALTERNATIVE)[0])) == [
+        ("1", "plain", "BASE64", "utf-8"),
+        ("2", "html", "7BIT", "utf-8"),
+    ]
+    assert list(_text_parts(_parse_imap_list(MIXED)[0])) == [
+        ("1.1", "html", "QUOTED-PRINTABLE", "utf-8"),
+    ]
+    assert list(_text_parts(_parse_imap_list(SINGLE)[0])) == [
+        ("1", "plain", "7BIT", "iso-8859-1"),
+    ]
+
+
+def test_split_fetch_response_inlines_structure_literals(analyzer):
+    msg_data = [
+        (b"7 (" + HEADER_ITEM, HEADER),
+        (b' BODYSTRUCTURE ("APPLICATION" "PDF" ("NAME" {9}', b'a"b c.pdf'),
+        b') NIL NIL "BASE64" 10 NIL NIL NIL))',
+    ]
+    [(num, response, header)] = analyzer._split_fetch_response(msg_data)
+    assert num == b"7"
+    assert header == HEADER
+    items = _parse_imap_list(response)[1]
+    structure = items[items.index("BODYSTRUCTURE") + 1]
+    assert structure[2] == ["NAME", 'a"b c.pdf']
+
+
+def test_decode_part_drops_undecodable_parts(analyzer):
+    assert analyzer._decode_part(b"SGVsbG8=", "plain", "BASE64", "utf-8") == "Hello"
+    assert analyzer._decode_part(b"SGVsbG8", "plain", "BASE64", "utf-8") == ""
+
+
+def test_fetch_chunk_downloads_only_text_parts(analyzer):
+    mail = FakeIMAP({
+        "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])": [
+            (b"1 (BODYSTRUCTURE " + ALTERNATIVE + b" " + HEADER_ITEM, HEADER), b")",
+            (b"2 (BODYSTRUCTURE " + MIXED + b" " + HEADER_ITEM, HEADER), b")",
+            (b"3 (BODYSTRUCTURE " + SINGLE + b" " + HEADER_ITEM, HEADER), b")",
+            # Unsolicited FLAGS updates, for a message outside the chunk and one inside it
+            b"5 (FLAGS (\\Seen))",
+            b"2 (FLAGS (\\Seen))",
+        ],
+        "(BODY.PEEK[1])": [
+            (b"1 (BODY[1] {16}", base64.b64encode(b"Hello, world")), b")",
+            (b"3 (BODY[1] {5}", b"caf\xe9"), b")",
+        ],
+        "(BODY.PEEK[1.1])": [
+            (b"2 (BODY[1.1] {16}", b"<b>caf=C3=A9</b>"), b")",
+        ],
+    })
+
+    results = analyzer._fetch_chunk(mail, [b"1", b"2", b"3"])
+
+    assert [body for _, _, _, body in results] == ["Hello, world", "café", "café"]
+    assert results[0][:3] == ("Bob <bob@example.com>", "Quarterly update", "Mon, 14 Oct 2024 10:00:00 +0000")
+    assert [items for _, items in mail.calls] == [
+        "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])",
+        "(BODY.PEEK[1])",
+        "(BODY.PEEK[1.1])",
+    ]
+
+
+def test_fetch_chunk_falls_back_to_peek_of_whole_message(analyzer):
+    raw_email = HEADER + b"Plain body"
+    mail = FakeIMAP({
+        "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])": [
+            (b'4 (BODYSTRUCTURE ("TEXT" "PLAIN" ' + HEADER_ITEM, HEADER), b")",
+        ],
+        "(BODY.PEEK[])": [
+            (b"4 (BODY[] {%d}" % len(raw_email), raw_email), b")",
+        ],
+    })
+
+    results = analyzer._fetch_chunk(mail, [b"4"])
+
+    assert results == [("Bob <bob@example.com>", "Quarterly update", "Mon, 14 Oct 2024 10:00:00 +0000", "Plain body")]
+    assert mail.calls[-1] == (b"4", "(BODY.PEEK[])")
+
+
+def test_summarize_scores_orders_secondary_emotions(analyzer):
+    analyzer._labels = np.array(["admiration", "anger", "joy", "sadness"])
+    scores = np.array([
+        [0.15, 0.05, 0.9, 0.4],
+        [0.2, 0.3, 0.1, 0.05],
+    ], dtype=np.float32)
+
+    tones = analyzer._summarize_scores(scores)
+
+    assert tones[0] == ("JOY", 0.9, {"sadness": 0.4, "admiration": 0.15})
+    assert list(tones[0][2]) == ["sadness", "admiration"]
+    assert tones[1] == ("ANGER", 0.3, {"admiration": 0.2})
+
+
+def test_clean_text_treats_unicode_whitespace_as_whitespace(analyzer):
+    text = "see http://x.y/a\xa0next word\n--\xa0\nsig"
+    assert analyzer.clean_text(text) == "see next word"
+
+
+def test_run_analysis_starts_a_new_report_each_run(analyzer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    analyzer._new_report()
+    monkeypatch.setattr(analyzer, "fetch_and_analyze_emails", lambda days_back: analyzer._write_row(
+        "Bob", "Hi", "today", ("JOY", 0.9, {}),
+    ))
+
+    analyzer.run_analysis()
+    analyzer.run_analysis()
+
+    assert analyzer._saved
+    assert analyzer._emotion_log == ["JOY"]
+    assert (tmp_path / analyzer.excel_file).exists()
+
+
+class FakeSMTP:
+    """Records sent messages; a dropped session raises like smtplib does"""
+
+    def __init__(self, dropped=False):
+        self.dropped = dropped
+        self.sent = []
+
+    def login(self, user, password):
+        pass
+
+    def send_message(self, msg):
+        if self.dropped:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent.append(msg)
+
+
+def test_send_message_reconnects_dropped_session(analyzer, monkeypatch):
+    opened = []
+    monkeypatch.setattr(smtplib, "SMTP_SSL", lambda host, port: opened.append(FakeSMTP()) or opened[-1])
+    analyzer.imap_server, analyzer.email_account, analyzer.email_password = "mail", "me", "pw"
+    analyzer._smtp_conn = FakeSMTP(dropped=True)
+    analyzer._smtp_used = time.monotonic()
+
+    analyzer._send_message("report")
+
+    assert [conn.sent for conn in opened] == [["report"]]
+    assert analyzer._smtp_conn is opened[0]
+
+
+def test_fetch_and_analyze_stops_fetcher_before_closing_session(analyzer, tmp_path, monkeypatch):
+    events = []
+
+    class FakeMailbox:
+        def search(self, charset, criteria):
+            return "OK", [b" ".join(str(n).encode() for n in range(1, 501))]
+
+    def fetch_chunk(mail, chunk):
+        events.append("fetch")
+        return [("Bob", "Hi", "today", "body")] * len(chunk)
+
+    def analyze_stage(fetch_queue, write_queue, total, batch_size):
+        fetch_queue.get()
+        raise RuntimeError("model failed")
+
+    fetch_worker = analyzer._fetch_worker
+
+    def tracked_fetch_worker(*args):
+        fetch_worker(*args)
+        events.append("fetcher done")
+
+    analyzer._cache_file = str(tmp_path / "emotions")
+    analyzer._cache = analyzer._cache_lock = None
+    monkeypatch.setattr(analyzer, "_imap", lambda: FakeMailbox())
+    monkeypatch.setattr(analyzer, "_fetch_chunk", fetch_chunk)
+    monkeypatch.setattr(analyzer, "_fetch_worker", tracked_fetch_worker)
+    monkeypatch.setattr(analyzer, "_analyze_stage", analyze_stage)
+    monkeypatch.setattr(analyzer, "_close_imap", lambda: events.append("close"))
+
+    analyzer.fetch_and_analyze_emails(batch_size=4)
+
+    # The fetcher gave up early and was done with the session before it was closed
+    assert events[-2:] == ["fetcher done", "close"]
+    assert events.count("fetch") < 10
+
+@pytest.fixture
+def model_analyzer(analyzer):
+    analyzer.tokenizer = FakeTokenizer()
+    analyzer.model = FakeModel()
+    analyzer.device = torch.device("cpu")
+    analyzer._labels = np.array(["long", "short"])
+    analyzer._cache = None
+    return analyzer
+
+
+def words(n):
+    return " ".join(["word"] * n)
+
+
+def test_analyze_tones_maps_scores_back_after_length_sort(model_analyzer):
+    texts = [words(12), words(5), words(10), words(6), words(20)]
+
+    tones = model_analyzer.analyze_tones(texts, batch_size=2)
+
+    expected = [
+        ("LONG" if n > 8 else "SHORT", round(float(torch.tensor(abs(n - 8.0)).sigmoid()), 3))
+        for n in (12, 5, 10, 6, 20)
+    ]
+    assert [tone[:2] for tone in tones] == expected
+    assert model_analyzer.model.batches == [2, 2, 1]
+
+
+def test_analyze_tones_cache_hit_skips_model(model_analyzer):
+    text = words(12)
+    content_hash = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+    model_analyzer._cache = {content_hash: ("JOY", 0.9, {})}
+
+    assert model_analyzer.analyze_tones([text]) == [("JOY", 0.9, {})]
+    assert model_analyzer.model.batches == []
+
+
+def test_analyze_tones_stores_results_in_cache(model_analyzer):
+    model_analyzer._cache = {}
+
+    [tone] = model_analyzer.analyze_tones([words(12)])
+
+    assert list(model_analyzer._cache.values()) == [tone]
+
+
+def test_analyze_tones_prefilters_trivial_and_boilerplate(model_analyzer):
+    tones = model_analyzer.analyze_tones([
+        "Thanks, see you soon",
+        "Your OTP is 123456, do not share it with anyone",
+        "",
+    ])
+
+    assert tones == [("NEUTRAL", 0.5, {}), ("NEUTRAL", 1.0, {}), ("NEUTRAL", 0.5, {})]
+    assert model_analyzer.model.batches == []
+
+
+def test_extract_email_body_prefers_plain_over_html(analyzer):
+    msg = MIMEMultipart("alternative")
+    msg.attach(MIMEText("<p>HTML <b>version</b></p>", "html"))
+    msg.attach(MIMEText("Plain version", "plain"))
+
+    assert analyzer.extract_email_body(msg) == "Plain version"
+
+
+def test_extract_email_body_strips_html_only_messages(analyzer):
+    msg = MIMEMultipart("alternative")
+    msg.attach(MIMEText("<p>HTML <b>version</b></p>", "html"))
+
+    assert analyzer.extract_email_body(msg).split() == ["HTML", "version"]
+
+
+def test_sanitize_for_excel():
+    assert sanitize_for_excel("Plain subject") == "Plain subject"
+    assert sanitize_for_excel("caf\xe9\x07\tbill") == "caf bill"
+    assert sanitize_for_excel("=SUM(A1:A3)") == "'=SUM(A1:A3)"
+    assert sanitize_for_excel("-\u2603 note") == "'- note"
+    assert sanitize_for_excel(None) == ""
+